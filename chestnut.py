@@ -1,15 +1,47 @@
 import os
 import argparse
+import asyncio
+import atexit
+import codecs
+import hashlib
+import json
 import re
-import psycopg2
+from collections import deque
+from functools import lru_cache
+from itertools import zip_longest
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import aiohttp
+import numpy as np
+from psycopg_pool import ConnectionPool
 from fastapi import FastAPI, UploadFile, File
 from fastapi.responses import JSONResponse
 import requests
+from requests.adapters import HTTPAdapter
 
 # ---- Config ----
 OLLAMA_URL = "http://localhost:11434/api/generate"
+OLLAMA_EMBED_URL = "http://localhost:11434/api/embeddings"
 LLM_MODEL = "llama3.1:8b"
+EMBED_MODEL = "nomic-embed-text"
+# Summarization prompts start with a fixed prefix and end with the note text so
+# Ollama can reuse the cached prefix; num_keep pins it (~4 characters per token).
+SUMMARIZE_PREFIX = "You are a concise summarizer. Summarize the note in 1-2 sentences.\n\nNOTE:\n"
+SUMMARIZE_BATCH_PREFIX = (
+    "You are a concise summarizer. For each numbered note below, output '### i: <summary>' "
+    "where i is the note number and the summary is 1-2 sentences.\n"
+)
+SUMMARIZE_OPTIONS = {"num_keep": len(SUMMARIZE_PREFIX) // 4}
+SUMMARIZE_BATCH_OPTIONS = {"num_keep": len(SUMMARIZE_BATCH_PREFIX) // 4}
 SUPPORTED_EXTS = {'.txt', '.md', '.markdown', '.rst', '.log', '.text'}
+SUMMARIZE_CONCURRENCY = 8
+SUMMARIZE_BATCH_SIZE = 5
+MAX_CONTEXT_TOKENS = 6000
+WALK_THREADS = 60
+READ_THREADS = 32
+IMPORT_CHUNK_SIZE = 500
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+SEMANTIC_CACHE = os.getenv("CHESTNUTAI_SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_THRESHOLD = 0.97
 DB_CONN_INFO = {
     'dbname': os.getenv("CHESTNUTAI_DB", "chestnutai"),
     'user': os.getenv("CHESTNUTAI_USER", "blenington"),
@@ -19,8 +51,18 @@ DB_CONN_INFO = {
 }
 
 # ---- DB Utils ----
+_pool = None
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool(kwargs=DB_CONN_INFO, min_size=2, max_size=16, open=True)
+        atexit.register(_pool.close)
+    return _pool
+
 def get_conn():
-    return psycopg2.connect(**DB_CONN_INFO)
+    # Commits on success, rolls back on error, and returns the connection to the pool
+    return get_pool().connection()
 
 def init_db():
     with get_conn() as conn:
@@ -32,32 +74,184 @@ def init_db():
                 content TEXT,
                 summary TEXT
             );
+            ALTER TABLE notes ADD COLUMN IF NOT EXISTS embedding BYTEA;
+            -- Only the start of the content is indexed: a tsvector is capped at 1 MB,
+            -- and large notes (logs especially) must still be storable
+            ALTER TABLE notes ADD COLUMN IF NOT EXISTS tsv tsvector GENERATED ALWAYS AS (
+                to_tsvector('english', coalesce(summary, '') || ' ' || left(coalesce(content, ''), 100000))
+            ) STORED;
+            CREATE INDEX IF NOT EXISTS notes_tsv_idx ON notes USING GIN (tsv);
+            ALTER TABLE notes ADD COLUMN IF NOT EXISTS sha256 BYTEA;
+            ALTER TABLE notes ADD COLUMN IF NOT EXISTS source_path TEXT;
+            CREATE UNIQUE INDEX IF NOT EXISTS notes_sha256_idx ON notes (sha256);
+            CREATE INDEX IF NOT EXISTS notes_source_path_idx ON notes (source_path);
+            CREATE TABLE IF NOT EXISTS imported_files (
+                path TEXT PRIMARY KEY,
+                mtime DOUBLE PRECISION NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key BYTEA PRIMARY KEY,
+                model TEXT,
+                response TEXT,
+                embedding BYTEA,
+                scope BYTEA
+            );
             """)
             conn.commit()
 
-def add_note(filename, content):
+def note_row(filename, content, source_path=None, known_hashes=(), digest=None):
+    # source_path is the absolute path of an imported file (None for uploads);
+    # digest may be passed in when the caller already hashed the raw UTF-8 bytes
+    if "\x00" in content:
+        raise ValueError("contains NUL characters, which Postgres text cannot store")
+    if digest is None:
+        digest = hashlib.sha256(content.encode("utf-8")).digest()
+    # Content already stored under another row won't be inserted, so don't embed it
+    embedding = None if digest in known_hashes else embed_text(content)
+    return (
+        filename,
+        content,
+        None if embedding is None else embedding.tobytes(),
+        digest,
+        source_path,
+    )
+
+def add_note(filename, content, digest=None):
+    return add_notes([note_row(filename, content, digest=digest)])[0]
+
+# One statement per note row:
+# - content already stored anywhere: skip (no id returned); if it was an imported
+#   file whose own row held an older version, that stale row is removed
+# - new content for a file imported before (same source_path): replace its row
+#   and reset its summary
+# - otherwise (including every upload): insert a new row
+UPSERT_NOTE_SQL = """
+WITH new (filename, content, embedding, sha256, source_path) AS (
+    VALUES (%s::text, %s::text, %s::bytea, %s::bytea, %s::text)
+),
+stored AS (
+    SELECT (SELECT max(n.id) FROM notes n, new WHERE n.source_path = new.source_path) AS id,
+           EXISTS (SELECT 1 FROM notes n, new WHERE n.sha256 = new.sha256) AS known
+),
+stale AS (
+    DELETE FROM notes n USING new, stored
+    WHERE n.id = stored.id AND stored.known AND n.sha256 IS DISTINCT FROM new.sha256
+),
+replaced AS (
+    UPDATE notes n
+    SET filename = new.filename, content = new.content, embedding = new.embedding,
+        sha256 = new.sha256, summary = NULL
+    FROM new, stored
+    WHERE n.id = stored.id AND NOT stored.known
+    RETURNING n.id
+),
+inserted AS (
+    INSERT INTO notes (filename, content, embedding, sha256, source_path)
+    SELECT new.* FROM new, stored
+    WHERE stored.id IS NULL AND NOT stored.known
+    ON CONFLICT (sha256) DO NOTHING
+    RETURNING id
+)
+SELECT id FROM replaced UNION ALL SELECT id FROM inserted
+"""
+
+def add_notes(rows):
+    # Returns, for each row, the id of the inserted/replaced note or None if skipped
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            # Pipeline mode sends every statement before waiting on any reply
+            with conn.pipeline():
+                cur.executemany(UPSERT_NOTE_SQL, rows, returning=True)
+            ids = []
+            while True:
+                row = cur.fetchone()
+                ids.append(row[0] if row else None)
+                if not cur.nextset():
+                    break
+            conn.commit()
+    invalidate_embeddings()
+    return ids
+
+def fetch_import_state():
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT path, mtime FROM imported_files")
+            mtimes = dict(cur.fetchall())
+            cur.execute("SELECT sha256 FROM notes WHERE sha256 IS NOT NULL")
+            hashes = {bytes(r[0]) for r in cur.fetchall()}
+    return mtimes, hashes
+
+def mark_imported(files):
+    # files are (absolute path, mtime) that were stored or found already stored
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.executemany(
+                "INSERT INTO imported_files (path, mtime) VALUES (%s, %s) "
+                "ON CONFLICT (path) DO UPDATE SET mtime = EXCLUDED.mtime",
+                files
+            )
+            conn.commit()
+
+def fetch_note_ids_missing_summary():
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id FROM notes WHERE summary IS NULL ORDER BY id")
+            return [r[0] for r in cur.fetchall()]
+
+def count_notes_missing_summary():
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM notes WHERE summary IS NULL")
+            return cur.fetchone()[0]
+
+def fetch_notes_missing_summary(after_id, limit):
+    # Keyset page: each call is its own short transaction, so a long summarize
+    # run never holds a connection idle in an open transaction
     with get_conn() as conn:
         with conn.cursor() as cur:
             cur.execute(
-                "INSERT INTO notes (filename, content) VALUES (%s, %s)",
-                (filename, content)
+                "SELECT id, filename, content FROM notes WHERE summary IS NULL AND id > %s "
+                "ORDER BY id LIMIT %s",
+                (after_id, limit)
             )
+            return cur.fetchall()
+
+def update_summaries(rows):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            # Lost summaries are simply regenerated, so don't wait on the WAL flush
+            cur.execute("SET LOCAL synchronous_commit = off")
+            with conn.pipeline():
+                cur.executemany("UPDATE notes SET summary = %s WHERE id = %s", rows)
             conn.commit()
+    invalidate_embeddings()
 
-def fetch_notes(missing_summary=False):
+def fetch_notes_missing_embedding(after_id, limit):
     with get_conn() as conn:
         with conn.cursor() as cur:
-            if missing_summary:
-                cur.execute("SELECT id, filename, content FROM notes WHERE summary IS NULL")
-            else:
-                cur.execute("SELECT id, filename, content, summary FROM notes")
+            cur.execute(
+                "SELECT id, content FROM notes WHERE embedding IS NULL AND id > %s "
+                "ORDER BY id LIMIT %s",
+                (after_id, limit)
+            )
             return cur.fetchall()
 
-def update_summary(note_id, summary):
+def update_embeddings(rows):
     with get_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("UPDATE notes SET summary = %s WHERE id = %s", (summary, note_id))
+            with conn.pipeline():
+                cur.executemany("UPDATE notes SET embedding = %s WHERE id = %s", rows)
             conn.commit()
+    invalidate_embeddings()
+
+def fetch_notes_by_id(note_ids):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT id, filename, content, summary FROM notes WHERE id = ANY(%s)",
+                (list(note_ids),)
+            )
+            return cur.fetchall()
 
 def fetch_all_summaries():
     with get_conn() as conn:
@@ -65,86 +259,476 @@ def fetch_all_summaries():
             cur.execute("SELECT id, filename, summary FROM notes WHERE summary IS NOT NULL")
             return cur.fetchall()
 
+# ---- LLM Cache ----
+# Exact hits are keyed on the full prompt. Semantic hits (optional) only apply to
+# questions: the embedding is of the question alone, and lookups are scoped to
+# answers given over the exact same context.
+def llm_cache_key(prompt):
+    return hashlib.sha256(f"{LLM_MODEL}\0{prompt}".encode()).digest()
+
+def context_scope(context):
+    return hashlib.sha256(context.encode()).digest()
+
+@lru_cache(maxsize=256)
+def question_embedding(question):
+    embedding = embed_text(question)
+    return None if embedding is None else embedding.tobytes()
+
+def semantic_cache_lookup(question, scope):
+    query = question_embedding(question)
+    if query is None:
+        return None
+    q = np.frombuffer(query, dtype=np.float32)
+    with get_conn() as conn:
+        with conn.cursor(binary=True) as cur:
+            cur.execute(
+                "SELECT key, embedding FROM llm_cache "
+                "WHERE model = %s AND scope = %s AND embedding IS NOT NULL",
+                (LLM_MODEL, scope)
+            )
+            rows = [r for r in cur.fetchall() if len(r[1]) == len(query)]
+            if not rows:
+                return None
+            matrix = np.vstack([np.frombuffer(r[1], dtype=np.float32) for r in rows])
+            norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(q)
+            scores = matrix @ q / np.maximum(norms, 1e-12)
+            best = int(np.argmax(scores))
+            if scores[best] < SEMANTIC_CACHE_THRESHOLD:
+                return None
+            cur.execute("SELECT response FROM llm_cache WHERE key = %s", (rows[best][0],))
+            row = cur.fetchone()
+            return row[0] if row else None
+
+def cached_response(prompt, question=None, scope=None):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT response FROM llm_cache WHERE key = %s", (llm_cache_key(prompt),))
+            row = cur.fetchone()
+    if row:
+        return row[0]
+    if SEMANTIC_CACHE and question is not None:
+        return semantic_cache_lookup(question, scope)
+    return None
+
+def store_response(prompt, response, question=None, scope=None):
+    embedding = question_embedding(question) if SEMANTIC_CACHE and question is not None else None
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO llm_cache (key, model, response, embedding, scope) "
+                "VALUES (%s, %s, %s, %s, %s) "
+                "ON CONFLICT (key) DO UPDATE SET response = EXCLUDED.response",
+                (llm_cache_key(prompt), LLM_MODEL, response, embedding, scope)
+            )
+            conn.commit()
+
 # ---- LLM ----
-def query_llm(prompt, context=None):
+# Shared keep-alive session so Ollama calls reuse their TCP connections
+_session = requests.Session()
+_session.headers.update({"Connection": "keep-alive"})
+_session.mount("http://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
+def query_llm(prompt, context=None, on_chunk=None, options=None):
+    # on_chunk, if given, is called with each piece of the response as it streams in
+    question = scope = None
     if context:
+        question, scope = prompt, context_scope(context)
         prompt = f"Context:\n{context}\n\nQuestion: {prompt}"
+    cached = cached_response(prompt, question, scope)
+    if cached is not None:
+        if on_chunk:
+            on_chunk(cached)
+        return cached
+    data = {
+        "model": LLM_MODEL,
+        "prompt": prompt,
+        "stream": True,
+    }
+    if options:
+        data["options"] = options
+    chunks = []
+    try:
+        with _session.post(OLLAMA_URL, json=data, timeout=120, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                part = json.loads(line)
+                if "error" in part:
+                    raise RuntimeError(part["error"])
+                chunk = part.get("response", "")
+                chunks.append(chunk)
+                if on_chunk and chunk:
+                    on_chunk(chunk)
+    except Exception as e:
+        return f"Error querying LLM: {e}"
+    answer = "".join(chunks).strip()
+    store_response(prompt, answer, question, scope)
+    return answer
+
+async def aquery_llm(session, prompt, options=None, use_cache=True):
+    # use_cache=False forces a fresh answer (which then replaces the cached one)
+    if use_cache:
+        cached = await asyncio.to_thread(cached_response, prompt)
+        if cached is not None:
+            return cached
     data = {
         "model": LLM_MODEL,
         "prompt": prompt,
         "stream": False,
     }
+    if options:
+        data["options"] = options
     try:
-        response = requests.post(OLLAMA_URL, json=data, timeout=120)
-        response.raise_for_status()
-        return response.json().get("response", "").strip()
+        timeout = aiohttp.ClientTimeout(total=120)
+        async with session.post(OLLAMA_URL, json=data, timeout=timeout) as response:
+            response.raise_for_status()
+            body = await response.json()
+            answer = body.get("response", "").strip()
     except Exception as e:
         return f"Error querying LLM: {e}"
+    await asyncio.to_thread(store_response, prompt, answer)
+    return answer
+
+def summarize_batch_prompt(contents):
+    prompt = SUMMARIZE_BATCH_PREFIX
+    for i, content in enumerate(contents, 1):
+        prompt += f"\n### Note {i}:\n{content}\n"
+    return prompt
+
+def split_batch_summaries(text, count):
+    # Returns None unless the model emitted exactly one summary for each note 1..count
+    parts = re.findall(r'###\s*(\d+):\s*(.*?)(?=###\s*\d+:|\Z)', text, re.S)
+    by_number = {int(i): summary.strip() for i, summary in parts}
+    if len(parts) != count or set(by_number) != set(range(1, count + 1)):
+        return None
+    if not all(by_number.values()):
+        return None
+    return [by_number[i] for i in range(1, count + 1)]
+
+async def asummarize_batch(session, contents, use_cache=True):
+    if len(contents) == 1:
+        prompt = SUMMARIZE_PREFIX + contents[0]
+        return [await aquery_llm(session, prompt, SUMMARIZE_OPTIONS, use_cache)]
+    prompt = summarize_batch_prompt(contents)
+    text = await aquery_llm(session, prompt, SUMMARIZE_BATCH_OPTIONS, use_cache)
+    if text.startswith("Error querying LLM"):
+        return [text] * len(contents)
+    summaries = split_batch_summaries(text, len(contents))
+    if summaries is None:
+        return [
+            await aquery_llm(session, SUMMARIZE_PREFIX + c, SUMMARIZE_OPTIONS, use_cache)
+            for c in contents
+        ]
+    return summaries
+
+async def asummarize_all(notes, batch_size=1, concurrency=SUMMARIZE_CONCURRENCY):
+    sem = asyncio.Semaphore(concurrency)
+    batches = [notes[i:i + batch_size] for i in range(0, len(notes), batch_size)]
+    async with aiohttp.ClientSession() as session:
+        async def bounded(batch):
+            async with sem:
+                return await asummarize_batch(session, [content for _, _, content in batch])
+        results = await asyncio.gather(*[bounded(b) for b in batches])
+    return [summary for batch in results for summary in batch]
+
+# Set while embedding requests are failing, so an outage is reported once rather than per note
+_embed_failing = False
+
+def embed_text(text):
+    global _embed_failing
+    data = {"model": EMBED_MODEL, "prompt": text}
+    try:
+        response = _session.post(OLLAMA_EMBED_URL, json=data, timeout=120)
+        response.raise_for_status()
+        embedding = np.asarray(response.json()["embedding"], dtype=np.float32)
+    except Exception as e:
+        if not _embed_failing:
+            _embed_failing = True
+            print(f"Failed to embed text with {EMBED_MODEL}: {e} (further failures not reported)")
+        return None
+    if _embed_failing:
+        _embed_failing = False
+        print("Embedding requests are succeeding again.")
+    return embedding
+
+def embed_missing_notes(page_size=100):
+    # Backfills notes imported before embeddings existed or whose embedding failed
+    embedded = 0
+    last_id = 0
+    with ThreadPoolExecutor(max_workers=READ_THREADS) as ex:
+        while rows := fetch_notes_missing_embedding(last_id, page_size):
+            last_id = rows[-1][0]
+            embeddings = ex.map(embed_text, [content for _, content in rows])
+            pending = [
+                (embedding.tobytes(), note_id)
+                for (note_id, _), embedding in zip(rows, embeddings)
+                if embedding is not None
+            ]
+            if not pending:
+                # Embedding model missing or Ollama down; retry on the next run instead of per note
+                print("Stopping embedding backfill: no embeddings could be computed.")
+                break
+            update_embeddings(pending)
+            embedded += len(pending)
+    return embedded
+
+# ---- Retrieval ----
+# (ids, matrix, norms, unembedded count) of summarized notes; reset whenever notes change
+_embedding_index = None
+
+def invalidate_embeddings():
+    global _embedding_index
+    _embedding_index = None
 
-def summarize_text(content):
-    prompt = f"Summarize this note in 1-2 sentences:\n\n{content}"
-    return query_llm(prompt)
+def load_embeddings():
+    global _embedding_index
+    if _embedding_index is None:
+        with get_conn() as conn:
+            # Binary results skip hex-encoding the embedding blobs
+            with conn.cursor(binary=True) as cur:
+                cur.execute(
+                    "SELECT id, embedding FROM notes "
+                    "WHERE embedding IS NOT NULL AND summary IS NOT NULL"
+                )
+                rows = cur.fetchall()
+                cur.execute(
+                    "SELECT count(*) FROM notes WHERE embedding IS NULL AND summary IS NOT NULL"
+                )
+                unembedded = cur.fetchone()[0]
+        if rows:
+            ids = np.array([r[0] for r in rows])
+            matrix = np.vstack([np.frombuffer(r[1], dtype=np.float32) for r in rows])
+            _embedding_index = (ids, matrix, np.linalg.norm(matrix, axis=1), unembedded)
+        else:
+            _embedding_index = (np.empty(0, dtype=int), None, None, unembedded)
+    return _embedding_index
 
-def score_summary(summary, question):
-    summary_words = set(re.findall(r'\w+', summary.lower()))
-    question_words = set(re.findall(r'\w+', question.lower()))
-    return len(summary_words & question_words)
+def top_embedded_notes(question, top_k=3):
+    ids, matrix, norms, _ = load_embeddings()
+    if not len(ids):
+        return None
+    q = embed_text(question)
+    if q is None or q.shape[0] != matrix.shape[1]:
+        return None
+    scores = matrix @ q / np.maximum(norms * np.linalg.norm(q), 1e-12)
+    k = min(top_k, len(ids))
+    best = np.argpartition(-scores, k - 1)[:k]
+    best = best[np.argsort(-scores[best])]
+    return load_ranked_notes({int(ids[i]): float(scores[i]) for i in best})
+
+def top_text_matches(question, top_k=3, unembedded_only=False):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT id, ts_rank_cd(tsv, q) AS score "
+                "FROM notes, plainto_tsquery('english', %s) q "
+                "WHERE tsv @@ q AND summary IS NOT NULL "
+                + ("AND embedding IS NULL " if unembedded_only else "")
+                + "ORDER BY score DESC LIMIT %s",
+                (question, top_k)
+            )
+            score_by_id = dict(cur.fetchall())
+    return load_ranked_notes(score_by_id)
+
+def load_ranked_notes(score_by_id):
+    # Content is only fetched for the notes that made the cut
+    if not score_by_id:
+        return []
+    rows = fetch_notes_by_id(score_by_id)
+    top = [(score_by_id[_id], fname, content, summary) for _id, fname, content, summary in rows]
+    return sorted(top, key=lambda t: t[0], reverse=True)
 
 def top_relevant_notes(question, top_k=3):
-    all_notes = fetch_notes()
-    scored = []
-    for _id, fname, content, summary in all_notes:
-        if summary is None:
-            continue
-        score = score_summary(summary, question)
-        scored.append((score, fname, content, summary))
-    top = sorted(scored, reverse=True)[:top_k]
-    return top
+    top = top_embedded_notes(question, top_k)
+    if not top:
+        # Fall back to full-text search when no embeddings are available
+        return top_text_matches(question, top_k)
+    if not load_embeddings()[3]:
+        return top
+    # Notes without an embedding yet are only reachable through full-text search,
+    # so interleave those matches by rank (the two score scales don't compare)
+    text = top_text_matches(question, top_k, unembedded_only=True)
+    merged = [note for pair in zip_longest(top, text) for note in pair if note]
+    return merged[:top_k]
+
+# ---- File Discovery ----
+def scan_dir(path):
+    files, subdirs = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                else:
+                    files.append(entry.path)
+    except OSError as e:
+        print(f"Failed to scan {path}: {e}")
+    return files, subdirs
+
+def parallel_walk(top, threads=WALK_THREADS):
+    # Like os.walk, but lists directories concurrently and yields file paths
+    with ThreadPoolExecutor(max_workers=threads) as ex:
+        pending = {ex.submit(scan_dir, top)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                files, subdirs = fut.result()
+                yield from files
+                pending |= {ex.submit(scan_dir, d) for d in subdirs}
+
+def read_note(fpath, folder_path, known_mtimes, known_hashes):
+    # Returns (row, mtime), or None for files whose mtime matches the last import
+    source_path = os.path.abspath(fpath)
+    mtime = os.stat(fpath).st_mtime
+    if known_mtimes.get(source_path) == mtime:
+        return None
+    with open(fpath, "r", encoding="utf-8") as f:
+        content = f.read()
+    relpath = os.path.relpath(fpath, folder_path)
+    return note_row(relpath, content, source_path, known_hashes), mtime
 
 # ---- Core Logic ----
-def import_folder(folder_path):
-    imported = 0
-    for root, dirs, files in os.walk(folder_path):
-        for fname in files:
-            ext = os.path.splitext(fname)[1].lower()
-            if ext in SUPPORTED_EXTS:
-                fpath = os.path.join(root, fname)
+def insert_import_rows(items):
+    # items are (fpath, row, mtime); a failing chunk is retried row by row so one
+    # bad file doesn't cost the rest of the import. Returns (imported, skipped).
+    imported = skipped = 0
+    for start in range(0, len(items), IMPORT_CHUNK_SIZE):
+        chunk = items[start:start + IMPORT_CHUNK_SIZE]
+        try:
+            results = list(zip(chunk, add_notes([row for _, row, _ in chunk])))
+        except Exception as e:
+            print(f"Bulk insert failed ({e}); retrying files one at a time")
+            results = []
+            for item in chunk:
                 try:
-                    with open(fpath, "r", encoding="utf-8") as f:
-                        content = f.read()
-                    add_note(os.path.relpath(fpath, folder_path), content)
-                    print(f"Imported: {fpath}")
-                    imported += 1
+                    results.append((item, add_notes([item[1]])[0]))
                 except Exception as e:
-                    print(f"Failed to import {fpath}: {e}")
-    print(f"Imported {imported} files.")
+                    print(f"Failed to import {item[0]}: {e}")
+        for (fpath, _, _), note_id in results:
+            if note_id is None:
+                print(f"Already stored: {fpath}")
+                skipped += 1
+            else:
+                print(f"Imported: {fpath}")
+                imported += 1
+        # Only files whose row was committed are skipped by mtime next time
+        if results:
+            mark_imported([(row[4], mtime) for (_, row, mtime), _ in results])
+    return imported, skipped
+
+def import_folder(folder_path):
+    paths = (
+        p for p in parallel_walk(folder_path)
+        if os.path.splitext(p)[1].lower() in SUPPORTED_EXTS
+    )
+    known_mtimes, known_hashes = fetch_import_state()
+    # Reads in flight are bounded and rows are flushed every IMPORT_CHUNK_SIZE files,
+    # so only about one chunk of content is held in memory at a time
+    in_flight = deque()
+    items = []
+    imported = skipped = unchanged = 0
+
+    def collect(fpath, fut):
+        nonlocal unchanged
+        try:
+            result = fut.result()  # (row, mtime) or None
+        except Exception as e:
+            print(f"Failed to import {fpath}: {e}")
+            return
+        if result is None:
+            unchanged += 1
+        else:
+            items.append((fpath, *result))
+
+    def flush():
+        nonlocal imported, skipped
+        added, already = insert_import_rows(items)
+        imported += added
+        skipped += already
+        items.clear()
+
+    with ThreadPoolExecutor(max_workers=READ_THREADS) as ex:
+        for fpath in paths:
+            in_flight.append((fpath, ex.submit(read_note, fpath, folder_path, known_mtimes, known_hashes)))
+            if len(in_flight) >= READ_THREADS * 2:
+                collect(*in_flight.popleft())
+            if len(items) >= IMPORT_CHUNK_SIZE:
+                flush()
+        while in_flight:
+            collect(*in_flight.popleft())
+            if len(items) >= IMPORT_CHUNK_SIZE:
+                flush()
+    if items:
+        flush()
+    print(f"Imported {imported} files, skipped {unchanged + skipped} unchanged.")
 
 def summarize_notes(batch_size=5):
-    notes = fetch_notes(missing_summary=True)
-    print(f"Found {len(notes)} notes needing summaries.")
-    for i, (note_id, fname, content) in enumerate(notes):
-        print(f"Summarizing [{i+1}/{len(notes)}]: {fname}")
-        summary = summarize_text(content)
-        # Check for error response and only store if summary is valid
-        if summary.startswith("Error querying LLM"):
-            print(f"  Failed to summarize: {summary}")
-            continue  # Do NOT update summary in DB
-        update_summary(note_id, summary)
-        print(f"  Summary: {summary[:80]}...")
+    embedded = embed_missing_notes()
+    if embedded:
+        print(f"Embedded {embedded} notes that were missing embeddings.")
+    total = count_notes_missing_summary()
+    print(f"Found {total} notes needing summaries.")
+    # Summarize one window of concurrent batches at a time and store it before the next
+    window = batch_size * SUMMARIZE_CONCURRENCY
+    done = 0
+    last_id = 0
+    while chunk := fetch_notes_missing_summary(last_id, window):
+        last_id = chunk[-1][0]
+        summaries = asyncio.run(asummarize_all(chunk, batch_size=batch_size))
+        pending = []
+        for (note_id, fname, _), summary in zip(chunk, summaries):
+            done += 1
+            print(f"Summarized [{done}/{total}]: {fname}")
+            # Check for error response and only store if summary is valid
+            if summary.startswith("Error querying LLM"):
+                print(f"  Failed to summarize: {summary}")
+                continue  # Do NOT update summary in DB
+            pending.append((summary, note_id))
+            print(f"  Summary: {summary[:80]}...")
+        if pending:
+            update_summaries(pending)
+
+def estimate_tokens(text):
+    # Rough count (~4 characters per token) so no model-specific tokenizer is needed
+    return len(text) // 4 + 1
+
+def build_context(top, max_tokens=MAX_CONTEXT_TOKENS):
+    # Group ranked notes by file so each summary and body is only sent once
+    files = {}
+    for _, fname, content, summary in top:
+        _, contents = files.setdefault(fname, (summary, []))
+        if content not in contents:
+            contents.append(content)
+    context = ""
+    used = []
+    budget = max_tokens
+    for fname, (summary, contents) in files.items():
+        block = f"[{fname}]\nSummary: {summary}\n---\n" + "\n".join(contents) + "\n\n"
+        if estimate_tokens(block) > budget:
+            if used:
+                break  # Drop this and any lower-ranked files
+            block = block[:budget * 4]
+        context += block
+        budget -= estimate_tokens(block)
+        used.append((fname, summary))
+    return context, used
 
 def ask_question(question, top_k=3):
     top = top_relevant_notes(question, top_k)
     if not top or top[0][0] == 0:
         print("No relevant notes found for your question.")
         return
-    context = ""
-    for _, fname, content, summary in top:
-        context += f"[{fname}]\n{content}\n\n"
+    context, used = build_context(top)
     print("Querying LLM on these top notes:")
-    for _, fname, _, summary in top:
+    for fname, summary in used:
         print(f"  - {fname}: {summary[:80]}...")
-    answer = query_llm(question, context)
-    print(f"\nAnswer:\n{answer}")
+    print("\nAnswer:")
+    answer = query_llm(question, context, on_chunk=lambda chunk: print(chunk, end="", flush=True))
+    if answer.startswith("Error querying LLM"):
+        print(answer)
+    else:
+        print()
 
 def list_summaries():
     notes = fetch_all_summaries()
@@ -184,42 +768,116 @@ def run_cli():
 # ---- FastAPI App ----
 app = FastAPI()
 
+# (note_id, refresh) jobs waiting to be summarized, consumed by background workers;
+# refresh jobs bypass the LLM cache so an explicit re-summarize gets a new answer
+_summary_queue = None
+_summary_session = None
+_summary_workers = []
+# Waiting note IDs mapped to their refresh flag, and IDs a worker is summarizing,
+# so repeat requests don't queue a note twice
+_queued = {}
+_in_flight = set()
+
+def enqueue_summary(note_id, refresh=False):
+    # Returns whether the request adds work: a new job, or a waiting job upgraded to a refresh
+    if note_id in _queued:
+        if refresh and not _queued[note_id]:
+            _queued[note_id] = True
+            return True
+        return False
+    if note_id in _in_flight and not refresh:
+        return False
+    # A refresh of a note already being summarized runs again after it
+    _queued[note_id] = refresh
+    _summary_queue.put_nowait(note_id)
+    return True
+
+async def summarize_and_store(session, note_ids, refresh=False):
+    rows = await asyncio.to_thread(fetch_notes_by_id, note_ids)
+    if not rows:
+        return
+    contents = [content for _, _, content, _ in rows]
+    summaries = await asummarize_batch(session, contents, use_cache=not refresh)
+    pending = []
+    for (note_id, fname, _, _), summary in zip(rows, summaries):
+        if summary.startswith("Error querying LLM"):
+            print(f"Failed to summarize {fname}: {summary}")
+            continue
+        pending.append((summary, note_id))
+    if pending:
+        await asyncio.to_thread(update_summaries, pending)
+
+async def summary_worker(session):
+    while True:
+        # Take whatever else is already queued (up to a batch) to share one prompt
+        note_ids = [await _summary_queue.get()]
+        while len(note_ids) < SUMMARIZE_BATCH_SIZE and not _summary_queue.empty():
+            note_ids.append(_summary_queue.get_nowait())
+        jobs = [(note_id, _queued.pop(note_id)) for note_id in note_ids]
+        _in_flight.update(note_ids)
+        try:
+            for refresh in (False, True):
+                batch = [note_id for note_id, r in jobs if r == refresh]
+                if batch:
+                    await summarize_and_store(session, batch, refresh)
+        except Exception as e:
+            print(f"Failed to summarize notes {note_ids}: {e}")
+        finally:
+            for note_id in note_ids:
+                _in_flight.discard(note_id)
+                _summary_queue.task_done()
+
 @app.on_event("startup")
-def startup():
+async def startup():
+    global _summary_queue, _summary_session
     init_db()
+    _summary_queue = asyncio.Queue()
+    _summary_session = aiohttp.ClientSession()
+    _summary_workers.extend(
+        asyncio.create_task(summary_worker(_summary_session)) for _ in range(SUMMARIZE_CONCURRENCY)
+    )
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in _summary_workers:
+        task.cancel()
+    await asyncio.gather(*_summary_workers, return_exceptions=True)
+    _summary_workers.clear()
+    await _summary_session.close()
 
 @app.post("/upload-note/")
 async def upload_note(file: UploadFile = File(...)):
-    content = await file.read()
     try:
-        decoded = content.decode("utf-8")
-        add_note(file.filename, decoded)
-        return {"status": "success"}
+        # Decode and hash chunk by chunk so the raw bytes are never held in full
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        digest = hashlib.sha256()
+        parts = []
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+            parts.append(decoder.decode(chunk))
+        parts.append(decoder.decode(b"", final=True))
+        content = "".join(parts)
+        del parts
+        note_id = await asyncio.to_thread(add_note, file.filename, content, digest.digest())
     except Exception as e:
         return JSONResponse(status_code=400, content={"status": "error", "detail": str(e)})
+    if note_id is None:
+        return {"status": "duplicate"}
+    enqueue_summary(note_id)
+    return JSONResponse(status_code=202, content={"status": "success", "note_id": note_id})
 
 @app.post("/summarize-note/{note_id}")
-def api_summarize_note(note_id: int):
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT content FROM notes WHERE id = %s", (note_id,))
-            row = cur.fetchone()
-            if not row:
-                return JSONResponse(status_code=404, content={"error": "Note not found"})
-            content = row[0]
-            summary = summarize_text(content)
-            update_summary(note_id, summary)
-            return {"note_id": note_id, "summary": summary}
+async def api_summarize_note(note_id: int):
+    if not await asyncio.to_thread(fetch_notes_by_id, [note_id]):
+        return JSONResponse(status_code=404, content={"error": "Note not found"})
+    enqueue_summary(note_id, refresh=True)
+    return JSONResponse(status_code=202, content={"note_id": note_id, "status": "queued"})
 
 @app.post("/summarize-all/")
-def api_summarize_all():
-    notes = fetch_notes(missing_summary=True)
-    results = []
-    for note_id, fname, content in notes:
-        summary = summarize_text(content)
-        update_summary(note_id, summary)
-        results.append({"note_id": note_id, "filename": fname, "summary": summary})
-    return results
+async def api_summarize_all():
+    missing = await asyncio.to_thread(fetch_note_ids_missing_summary)
+    note_ids = [note_id for note_id in missing if enqueue_summary(note_id)]
+    return JSONResponse(status_code=202, content={"status": "queued", "note_ids": note_ids})
 
 @app.get("/summaries/")
 def api_list_summaries():
@@ -231,13 +889,12 @@ def api_ask_question(question: str, top_k: int = 3):
     top = top_relevant_notes(question, top_k)
     if not top or top[0][0] == 0:
         return {"answer": "No relevant notes found for your question.", "used_notes": []}
-    context = ""
-    used_files = []
-    for _, fname, content, summary in top:
-        context += f"[{fname}]\n{content}\n\n"
-        used_files.append({"filename": fname, "summary": summary})
+    context, used = build_context(top)
     answer = query_llm(question, context)
-    return {"answer": answer, "used_notes": used_files}
+    return {
+        "answer": answer,
+        "used_notes": [{"filename": fname, "summary": summary} for fname, summary in used],
+    }
 
 # ---- Entrypoint ----
 if __name__ == "__main__":